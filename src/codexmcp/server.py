@@ -2,22 +2,53 @@
 
 from __future__ import annotations
 
+import asyncio
 import json
 import os
-import queue
-import subprocess
-import threading
-import time
+import re
 import uuid
+from contextlib import aclosing
 from pathlib import Path
-from typing import Annotated, Any, Dict, Generator, List, Literal, Optional
+from typing import Annotated, Any, AsyncGenerator, Dict, List, Literal, Optional
 
 from mcp.server.fastmcp import FastMCP
 from pydantic import BeforeValidator, Field
 import shutil
 
+try:
+    import orjson
+except ImportError:  # optional speedup, fall back to the stdlib decoder
+    orjson = None
+
+if orjson is not None:
+    _json_loads = orjson.loads
+    _JSON_DECODE_ERRORS: tuple[type[Exception], ...] = (orjson.JSONDecodeError, json.JSONDecodeError)
+else:
+    _json_loads = json.loads
+    # json.loads decodes bytes itself and raises UnicodeDecodeError on bad UTF-8.
+    _JSON_DECODE_ERRORS = (json.JSONDecodeError, UnicodeDecodeError)
+
+try:
+    import simdjson
+except ImportError:  # optional speedup, see `_parse_event`
+    simdjson = None
+
 mcp = FastMCP("Codex MCP Server-from guda.studio")
 
+# Transient "Reconnecting... 1/5" notices are reported as error events but
+# are not fatal to the session.
+_RECONNECT_RE = re.compile(r'^Reconnecting\.\.\.\s+\d+/\d+')
+
+# Output is read in large chunks and split into lines ourselves: one read
+# usually yields many events, and a single event (e.g. a command with large
+# output) may be longer than asyncio's 64 KiB readline() limit.
+_READ_CHUNK_SIZE = 1 << 16
+
+_IS_WINDOWS = os.name == "nt"
+
+# Leading arguments shared by every `codex exec` invocation.
+_CODEX_EXEC_ARGS = ("codex", "exec", "--json")
+
 
 def _empty_str_to_none(value: str | None) -> str | None:
     """Convert empty strings to None for optional UUID parameters."""
@@ -26,83 +57,120 @@ def _empty_str_to_none(value: str | None) -> str | None:
     return value
 
 
-def run_shell_command(cmd: list[str]) -> Generator[str, None, None]:
+_codex_path_cache: str | None = None
+
+
+def _codex_path() -> str | None:
+    """Resolve the codex executable on PATH, reusing it once it is found.
+
+    A miss is not cached, so installing codex while the server is running
+    is picked up by the next call.
+    """
+    global _codex_path_cache
+    if _codex_path_cache is None:
+        _codex_path_cache = shutil.which('codex')
+    return _codex_path_cache
+
+
+def _parse_event(parser: Any, line: bytes) -> Any:
+    """Decode one line of codex output with the available JSON backend.
+
+    Raises one of `_JSON_DECODE_ERRORS` if the line is not valid JSON.
+    """
+    if parser is None:
+        return _json_loads(line)
+    try:
+        # recursive=True builds plain dicts/lists, so no proxy into the
+        # parser's buffer outlives this call and the parser can be reused.
+        return parser.parse(line, True)
+    except ValueError as error:
+        # pysimdjson reports malformed documents as plain ValueError.
+        raise json.JSONDecodeError(str(error), line.decode('utf-8', errors='replace'), 0) from None
+
+
+async def run_shell_command(cmd: list[str]) -> AsyncGenerator[bytes, None]:
     """Execute a command and stream its output line-by-line.
 
+    Output is read on the event loop, so the server keeps serving other
+    requests while codex is running.
+
     Args:
         cmd: Command and arguments as a list (e.g., ["codex", "exec", "prompt"])
 
     Yields:
-        Output lines from the command
+        Output lines from the command as stripped, undecoded bytes; the JSON
+        parsers validate UTF-8 themselves. The process is stopped when the
+        consumer closes the generator, e.g. once it has seen `turn.completed`.
     """
-    # On Windows, codex is exposed via a *.cmd shim. Use cmd.exe with /s so
-    # user prompts containing quotes/newlines aren't reinterpreted as shell syntax.
-    popen_cmd = cmd.copy()
-    codex_path = shutil.which('codex') or cmd[0]
-    popen_cmd[0] = codex_path
-
-    process = subprocess.Popen(
-        popen_cmd,
-        shell=False,
-        stdin=subprocess.DEVNULL,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        universal_newlines=True,
-        encoding='utf-8',
+    # Resolve codex through PATH (on Windows it is a *.cmd shim, which exec
+    # cannot find by bare name) and exec it directly, without a shell.
+    codex_path = _codex_path() or cmd[0]
+
+    process = await asyncio.create_subprocess_exec(
+        codex_path,
+        *cmd[1:],
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
     )
+    assert process.stdout is not None
 
-    output_queue: queue.Queue[str | None] = queue.Queue()
     GRACEFUL_SHUTDOWN_DELAY = 0.3
 
-    def is_turn_completed(line: str) -> bool:
-        """Check if the line indicates turn completion via JSON parsing."""
-        try:
-            data = json.loads(line)
-            return data.get("type") == "turn.completed"
-        except (json.JSONDecodeError, AttributeError, TypeError):
-            return False
-
-    def read_output() -> None:
-        """Read process output in a separate thread."""
-        if process.stdout:
-            for line in iter(process.stdout.readline, ""):
-                stripped = line.strip()
-                output_queue.put(stripped)
-                if is_turn_completed(stripped):
-                    time.sleep(GRACEFUL_SHUTDOWN_DELAY)
+    buffer = bytearray()
+    try:
+        while True:
+            chunk = await process.stdout.read(_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            # Only the new chunk can contain the last newline.
+            end = chunk.rfind(b"\n")
+            buffer += chunk
+            if end < 0:
+                continue
+            end += len(buffer) - len(chunk)
+            # Slicing a bytearray copies; go through a view so the complete
+            # lines are copied only once, into bytes.
+            lines = bytes(memoryview(buffer)[:end]).split(b"\n")
+            del buffer[:end + 1]
+            for raw in lines:
+                yield raw.strip()
+        if buffer:
+            yield bytes(buffer).strip()
+    finally:
+        # Stop codex if the consumer left before it closed its output (turn
+        # completed, unexpected error or cancellation), but give it a short
+        # grace period to exit on its own first.
+        if process.returncode is None and not process.stdout.at_eof():
+            try:
+                await asyncio.wait_for(process.wait(), timeout=GRACEFUL_SHUTDOWN_DELAY)
+            except asyncio.TimeoutError:
+                try:
                     process.terminate()
-                    break
-            process.stdout.close()
-        output_queue.put(None)
-
-    thread = threading.Thread(target=read_output)
-    thread.start()
-
-    # Yield lines while process is running
-    while True:
+                except ProcessLookupError:
+                    pass
         try:
-            line = output_queue.get(timeout=0.5)
-            if line is None:
-                break
-            yield line
-        except queue.Empty:
-            if process.poll() is not None and not thread.is_alive():
-                break
+            await asyncio.wait_for(process.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            await process.wait()
 
-    try:
-        process.wait(timeout=5)
-    except subprocess.TimeoutExpired:
-        process.kill()
-        process.wait()
-    thread.join(timeout=5)
+# 单次 str.translate 扫描完成全部转义；每个字符独立映射，无需关心替换顺序
+# （原先必须先处理反斜杠，避免它干扰其他替换）。
+_WIN_ESCAPE_TABLE = str.maketrans({
+    '\\': '\\\\',  # 反斜杠
+    '"': '\\"',     # 双引号，防止字符串边界乱套
+    '\n': '\\n',    # 换行符，Windows 常用 \r\n，但我们分开转义
+    '\r': '\\r',
+    '\t': '\\t',    # 制表符，空格的“超级版”
+    '\b': '\\b',    # 退格符（像按了后退键）
+    '\f': '\\f',    # 换页符（打印机跳页用）
+    "'": "\\'",     # 单引号（Windows 命令行不那么严格，但保险起见）
+})
 
-    while not output_queue.empty():
-        try:
-            line = output_queue.get_nowait()
-            if line is not None:
-                yield line
-        except queue.Empty:
-            break
 
 def windows_escape(prompt):
     """
@@ -110,22 +178,7 @@ def windows_escape(prompt):
     把常见特殊字符转义成 \\ 形式，适合命令行、JSON 或路径使用。
     比如：\n 变成 \\n，" 变成 \\"。
     """
-    # 先处理反斜杠，避免它干扰其他替换
-    result = prompt.replace('\\', '\\\\')
-    # 双引号，转义成 \"，防止字符串边界乱套
-    result = result.replace('"', '\\"')
-    # 换行符，Windows 常用 \r\n，但我们分开转义
-    result = result.replace('\n', '\\n')
-    result = result.replace('\r', '\\r')
-    # 制表符，空格的“超级版”
-    result = result.replace('\t', '\\t')
-    # 其他常见：退格符（像按了后退键）、换页符（打印机跳页用）
-    result = result.replace('\b', '\\b')
-    result = result.replace('\f', '\\f')
-    # 如果有单引号，也转义下（不过 Windows 命令行不那么严格，但保险起见）
-    result = result.replace("'", "\\'")
-    
-    return result
+    return prompt.translate(_WIN_ESCAPE_TABLE)
 
 @mcp.tool(
     name="codex",
@@ -193,76 +246,80 @@ async def codex(
 ) -> Dict[str, Any]:
     """Execute a Codex CLI session and return the results."""
     # Build command as list to avoid injection
-    cmd = ["codex", "exec", "--sandbox", sandbox, "--cd", str(cd), "--json"]
-    
-    if len(image):
-        cmd.extend(["--image", ",".join(image)])
-        
-    if model:
-        cmd.extend(["--model", model])
-        
-    if profile:
-        cmd.extend(["--profile", profile])
-        
-    if yolo:
-        cmd.append("--yolo")
-    
-    if skip_git_repo_check:
-        cmd.append("--skip-git-repo-check")
-
-    if SESSION_ID:
-        cmd.extend(["resume", str(SESSION_ID)])
-        
-    if os.name == "nt":
-        PROMPT = windows_escape(PROMPT)
-    else:
-        PROMPT = PROMPT
-    cmd += ['--', PROMPT]
+    cmd = [
+        *_CODEX_EXEC_ARGS, "--sandbox", sandbox, "--cd", str(cd),
+        *(("--image", ",".join(str(path) for path in image)) if image else ()),
+        *(("--model", model) if model else ()),
+        *(("--profile", profile) if profile else ()),
+        *(("--yolo",) if yolo else ()),
+        *(("--skip-git-repo-check",) if skip_git_repo_check else ()),
+        *(("resume", str(SESSION_ID)) if SESSION_ID else ()),
+        "--", windows_escape(PROMPT) if _IS_WINDOWS else PROMPT,
+    ]
 
     all_messages: list[Dict[str, Any]] = []
-    agent_messages = ""
+    agent_message_parts: list[str] = []
     success = True
-    err_message = ""
+    # (tag, detail) pairs, formatted into the error message once at the end.
+    err_parts: list[tuple[str, str]] = []
     thread_id: Optional[str] = None
+    # orjson is faster on the small and escape-heavy events codex emits most;
+    # simdjson only stands in for it when orjson is not installed. One parser
+    # is shared by all lines so its internal buffers are allocated once.
+    parser = simdjson.Parser() if simdjson is not None and orjson is None else None
 
-    for line in run_shell_command(cmd):
-        try:
-            line_dict = json.loads(line.strip())
-            all_messages.append(line_dict)
-            item = line_dict.get("item", {})
-            item_type = item.get("type", "")
-            if item_type == "agent_message":
-                agent_messages = agent_messages + item.get("text", "")
-            if line_dict.get("thread_id") is not None:
-                thread_id = line_dict.get("thread_id")
-            if "fail" in line_dict.get("type", ""):
-                success = False if len(agent_messages) == 0 else success
-                err_message += "\n\n[codex error] " + line_dict.get("error", {}).get("message", "")
-            if "error" in line_dict.get("type", ""):
-                error_msg = line_dict.get("message", "")
-                import re
-                is_reconnecting = bool(re.match(r'^Reconnecting\.\.\.\s+\d+/\d+', error_msg))
+    async with aclosing(run_shell_command(cmd)) as lines:
+        async for line in lines:
+            try:
+                try:
+                    line_dict = _parse_event(parser, line)
+                except _JSON_DECODE_ERRORS:
+                    # import sys
+                    # print(f"Ignored non-JSON line: {line}", file=sys.stderr)
+                    err_parts.append(("json decode error", line.decode('utf-8', errors='replace')))
+                    continue
+
+                # Only keep the transcript when it is going to be returned.
+                if return_all_messages:
+                    all_messages.append(line_dict)
+                msg_type = line_dict.get("type") or ""
+                item = line_dict.get("item")
+                if item is not None and item.get("type") == "agent_message":
+                    text = item.get("text", "")
+                    if not isinstance(text, str):
+                        raise TypeError(f"agent_message text must be str, not {type(text).__name__}")
+                    if text:
+                        agent_message_parts.append(text)
+                if line_dict.get("thread_id") is not None:
+                    thread_id = line_dict.get("thread_id")
+                if "fail" in msg_type:
+                    success = False if not agent_message_parts else success
+                    event_error = line_dict.get("error")
+                    err_parts.append(("codex error", event_error.get("message", "") if event_error is not None else ""))
+                if "error" in msg_type:
+                    error_msg = line_dict.get("message", "")
+                    is_reconnecting = _RECONNECT_RE.match(error_msg) is not None
                 
-                if not is_reconnecting:
-                    success = False if len(agent_messages) == 0 else success
-                    err_message += "\n\n[codex error] " + error_msg
-                    
-        except json.JSONDecodeError:
-            # import sys
-            # print(f"Ignored non-JSON line: {line}", file=sys.stderr)
-            err_message += "\n\n[json decode error] " + line
-            continue
-            
-        except Exception as error:
-            err_message += "\n\n[unexpected error] " + f"Unexpected error: {error}. Line: {line!r}"
-            success = False
-            break
+                    if not is_reconnecting:
+                        success = False if not agent_message_parts else success
+                        err_parts.append(("codex error", error_msg))
+
+                if msg_type == "turn.completed":
+                    break
+
+            except Exception as error:
+                err_parts.append(("unexpected error", f"Unexpected error: {error}. Line: {line.decode('utf-8', errors='replace')!r}"))
+                success = False
+                break
+
+    agent_messages = "".join(agent_message_parts)
+    err_message = "".join(f"\n\n[{tag}] {detail}" for tag, detail in err_parts)
 
     if thread_id is None:
         success = False
         err_message = "Failed to get `SESSION_ID` from the codex session. \n\n" + err_message
         
-    if len(agent_messages) == 0:
+    if not agent_message_parts:
         success = False
         err_message = "Failed to get `agent_messages` from the codex session. \n\n You can try to set `return_all_messages` to `True` to get the full reasoning information. " + err_message
 